@@ -13,11 +13,27 @@ plt.rcParams['pdf.fonttype'] = 42
 plt.rcParams['ps.fonttype'] = 42
 plt.rcParams['svg.fonttype'] = 'none'
 
-__all__ = ["pearsonr_2d", "get_axis_coords", "Dataset"]
+__all__ = ["pearsonr_2d", "pearsonr_2d_prezscored", "get_axis_coords",
+           "Dataset"]
 
-# Small value added to some denominators to avoid zero division
+# Small value added to some denominators to avoid zero division.
+# Kept as a python float so that it does not upcast float32 arrays.
 EPSILON = 1e-9
 
+# Arrays larger than this (in bytes) are correlated in row blocks
+# of roughly CHUNK_BYTES, which fit in L2 cache
+CHUNK_THRESH_BYTES = 64 * 2 ** 20
+CHUNK_BYTES = 256 * 2 ** 10
+
+
+def _normalize_rows(X, dtype):
+    """Return a copy of a 2d-array (of the given floating dtype)
+    with rows centered and scaled to unit (L2) norm"""
+
+    X_n = X - X.mean(1, dtype=dtype, keepdims=True)
+    X_n /= np.linalg.norm(X_n, axis=1, keepdims=True) + EPSILON
+    return X_n
+
 
 def pearsonr_2d(A, B):
     """Calculate row-wise Pearson's correlation between 2 2d-arrays
@@ -34,18 +50,51 @@ def pearsonr_2d(A, B):
         N x M shaped correlation matrix between all row combinations of A and B
     """
 
-    #  Subtract row-wise mean from input arrays
-    A_mA = A - A.mean(1)[:, None]
-    B_mB = B - B.mean(1)[:, None]
+    # Compute in the floating dtype of A (e.g. float32), avoiding upcasts
+    dtype = np.result_type(A.dtype, np.float32)
+    B = np.asarray(B, dtype=dtype)
 
-    # Sum of squares across rows
-    ssA = (A_mA ** 2).sum(1)
-    ssB = (B_mB ** 2).sum(1)
+    # Center rows and scale them to unit (L2) norm, so that
+    # the correlation coefficient reduces to a matrix product
+    B_n = _normalize_rows(B, dtype)
+    if A.nbytes <= CHUNK_THRESH_BYTES:
+        return np.dot(_normalize_rows(A, dtype), B_n.T)
 
-    # Finally get and return correlation coefficient
-    numerator = np.dot(A_mA, B_mB.T)
-    denominator = np.sqrt(np.dot(ssA[:, None], ssB[None])) + EPSILON
-    return numerator / denominator
+    # For large A, process blocks of rows, writing each product
+    # directly into the output (avoids a normalized copy of A)
+    R = np.empty((A.shape[0], B.shape[0]), dtype=dtype)
+    step = max(1, CHUNK_BYTES // (A.shape[1] * A.itemsize))
+    for start in range(0, A.shape[0], step):
+        stop = start + step
+        np.matmul(_normalize_rows(A[start:stop], dtype), B_n.T,
+                  out=R[start:stop])
+    return R
+
+
+def pearsonr_2d_prezscored(A, B, ddof=0):
+    """Calculate row-wise Pearson's correlation between 2 2d-arrays
+    whose rows have already been z-scored
+
+    Parameters
+    ----------
+    A : 2d-array
+        shape N x T, z-scored along rows
+    B : 2d-array or 1d-array
+        shape M x T, z-scored along rows, or a single z-scored
+        signal of shape T
+    ddof : int
+        Delta degrees of freedom used when z-scoring the rows.
+        Default: 0 (as in scipy.stats.zscore)
+    Returns
+    -------
+    R : 2d-array or 1d-array
+        N x M shaped correlation matrix between all row combinations of A and B
+        If B is 1d, a 1d-array of N correlation values.
+    """
+
+    # Rows are centered with norm sqrt(T - ddof), so no further
+    # normalization is needed
+    return np.dot(A, B.T) / (A.shape[1] - ddof)
 
 
 def get_axis_coords(fig, ax):
@@ -113,6 +162,19 @@ class Dataset(object):
         print(f"\tMask file: {mask_file}")
         print(f"\tOutput directory: {output_dir}")
 
+    @property
+    def carpet(self):
+        """ Carpet matrix (voxels x time).
+        Assigning a new carpet marks it as not z-scored, so that
+        correlations with it are computed from scratch.
+        """
+        return self._carpet
+
+    @carpet.setter
+    def carpet(self, carpet):
+        self._carpet = carpet
+        self._carpet_is_zscored = False
+
     def import_data(self):
         """ Load fMRI and mask data using nibabel.
         """
@@ -121,7 +183,10 @@ class Dataset(object):
         # Check if input files exist and try importing them with nibabel
         if os.path.isfile(self.fmri_file):
             try:
-                fmri_nifti = nib.load(self.fmri_file)
+                # The whole volume is read (and converted) once,
+                # so memory-mapping would not save anything.
+                # nibabel reads .nii.gz via indexed_gzip when installed.
+                fmri_nifti = nib.load(self.fmri_file, mmap=False)
             except IOError:
                 print(f"Could not load {self.fmri_file} using nibabel.")
                 print("Make sure it's a valid NIFTI file.")
@@ -138,8 +203,10 @@ class Dataset(object):
             print(f"Could not find {self.mask_file} file.")
 
         # Ensure that data dimensions are correct
-        data = fmri_nifti.get_fdata()
-        mask = mask_nifti.get_fdata()
+        # fMRI data are read as float32 (rather than the float64 returned
+        # by get_fdata) to halve memory usage
+        data = np.asarray(fmri_nifti.dataobj, dtype=np.float32)
+        mask = mask_nifti.get_fdata(dtype=np.float32)
         print(f"\tfMRI data read: dimensions {data.shape}")
         print(f"\tMask read: dimensions {mask.shape}")
         if len(data.shape) != 4:
@@ -182,57 +249,101 @@ class Dataset(object):
             Default: False
         """
 
-        # compute fMRI data mean, std, and tSNR across time
-        data_mean = self.data.mean(axis=-1, keepdims=True)
-        data_std = self.data.std(axis=-1, keepdims=True)
-        data_tsnr = data_mean / (data_std + EPSILON)
+        # Boolean indexing of voxels within 'mask' directly yields
+        # a 2-d (voxels x time) matrix
+        carpet = self.data[self.mask >= 0.5]
+
+        # Compute voxel mean and variance across time
+        # Row sums and sums of squares are gathered in a single pass
+        # (einsum avoids a temporary squared carpet), accumulating
+        # in float64. Only voxels within the mask are visited.
+        carpet_mean = carpet.sum(axis=1, dtype=np.float64) / self.t
+        carpet_sq = np.einsum('ij,ij->i', carpet, carpet,
+                              dtype=np.float64) / self.t
+        carpet_var = np.maximum(carpet_sq - carpet_mean ** 2, 0)
 
-        # Mask fMRI data array with 'mask'
-        # Also mask voxels below tSNR threshold (if given)
-        mask = self.mask < 0.5
-        mask_4d = np.repeat(mask[:, :, :, np.newaxis], self.t, axis=3)
-        tsnr_mask_4d = np.zeros(mask_4d.shape, dtype=bool)
+        # Also exclude voxels below tSNR threshold (if given)
         if tSNR_thresh is not None:
-            tsnr_mask = data_tsnr.squeeze() < tSNR_thresh
-            tsnr_mask_4d = np.repeat(tsnr_mask[:, :, :, np.newaxis],
-                                     self.t, axis=3)
-        data_masked = np.ma.masked_where(mask_4d | tsnr_mask_4d, self.data)
-
-        # Reshape data in 2-d (voxels x time)
-        data_2d = data_masked.reshape((-1, self.t))
-        print(f"fMRI data reshaped to voxels x time {data_2d.shape}.")
-
-        # Get indices for non-masked rows (voxels)
-        indices_valid = np.where(np.any(~np.ma.getmask(data_2d), axis=1))[0]
-        print(f"{len(indices_valid)} voxels retained after masking.")
-        # Keep only valid rows in carpet matrix
-        carpet = data_2d[indices_valid, :].data
+            carpet_tsnr = carpet_mean / (np.sqrt(carpet_var) + EPSILON)
+            valid = carpet_tsnr >= tSNR_thresh
+            carpet = carpet[valid]
+            carpet_mean = carpet_mean[valid]
+            carpet_var = carpet_var[valid]
+        print(f"{carpet.shape[0]} voxels retained after masking.")
         print(f"Carpet matrix created with shape {carpet.shape}.")
 
-        # Normalize carpet (z-score)
-        carpet = zscore(carpet, axis=1)
+        # Normalize carpet (z-score), in-place
+        # Per-row statistics are cast to the carpet dtype, so that
+        # the in-place operations need no casting buffers, and
+        # the division is replaced by multiplication with the reciprocal
+        carpet_scale = 1 / (np.sqrt(carpet_var) + EPSILON)
+        carpet -= carpet_mean.astype(carpet.dtype)[:, None]
+        carpet *= carpet_scale.astype(carpet.dtype)[:, None]
         print(f"Carpet normalized to zero-mean unit-variance.")
 
         # Re-order carpet plot based on correlation with the global signal
         if reorder_carpet:
-            gs = np.mean(carpet, axis=0)
-            gs_corr = pearsonr_2d(carpet, gs.reshape((1, self.t))).flatten()
-            sort_index = [int(i) for i in np.flip(np.argsort(gs_corr))]
-            carpet = carpet[sort_index, :]
+            # The global signal is z-scored once (in-place), so that
+            # its correlation with the carpet is a scaled dot product
+            gs = carpet.mean(axis=0)
+            gs -= gs.mean()
+            gs /= gs.std() + EPSILON
+            gs_corr = pearsonr_2d_prezscored(carpet, gs)
+            sort_index = np.argsort(-gs_corr)
+            carpet = carpet[sort_index]
             print('Carpet reordered.')
 
         # Save carpet to npy file
         if save_carpet:
-            np.save(os.path.join(self.output_dir, 'carpet.npy'), carpet)
+            np.save(os.path.join(self.output_dir, 'carpet.npy'),
+                    carpet.astype(np.float32, copy=False))
             print("Carpet saved as 'carpet.npy'.")
 
+        # Flag set after assigning the carpet, since assignment clears it
         self.carpet = carpet
+        self._carpet_is_zscored = True
         return
 
-    def fit_pca2carpet(self, save_pca_scores=False):
+    def load_carpet(self, mmap=True):
+        """ Loads a carpet matrix previously saved by :get_carpet:
+        (with save_carpet=True) from the output directory.
+        This allows skipping :import_data: and :get_carpet:
+        when fitting PCA to an existing carpet.
+        The file is not checked: it must be a (z-scored) carpet saved
+        by :get_carpet:, otherwise correlations with it will be wrong.
+
+        Parameters
+        ----------
+        mmap : boolean
+            Whether to memory-map the carpet file instead of reading
+            it entirely into memory. A memory-mapped carpet is read-only;
+            operations that modify it in-place must copy it first.
+            Default: True
+
+        Returns
+        -------
+        carpet : 2d-array
+            Carpet matrix (voxels x time), also stored as :self.carpet:
+        """
+
+        carpet_file = os.path.join(self.output_dir, 'carpet.npy')
+        if not os.path.isfile(carpet_file):
+            raise IOError(f"Could not find {carpet_file} file.")
+        carpet = np.load(carpet_file, mmap_mode='r' if mmap else None)
+        print(f"Carpet loaded from 'carpet.npy' with shape {carpet.shape}.")
+
+        self.t = carpet.shape[1]
+        self.carpet = carpet
+        self._carpet_is_zscored = True
+        return carpet
+
+    def fit_pca2carpet(self, save_pca_scores=False, ncomp=5,
+                       save_all_pcs=False):
         """ Fits PCA to carpet matrix and saves the principal
         componens (PCs), the explained variance ratios,
-        and optionally the PCA scores (PCA-tranformed carpet)
+        and optionally the PCA scores (PCA-tranformed carpet).
+        By default only the first :ncomp: PCs are computed,
+        using randomized (truncated) SVD.
 
         Parameters
         ----------
@@ -240,37 +351,67 @@ class Dataset(object):
             Whether to save the PCA scores (transformed carpet)
             in the output directory. The file might be large
             (possibly > 100MB depending on fMRI data and mask size).
+            Scores are saved as 'PCA_scores_First{ncomp}.npy'
+            (or as 'PCA_scores_all.npy' if :save_all_pcs: is True).
+            Default: False
+        ncomp : int
+            Number of PCA components to compute. These first PCs (fPCs)
+            are later correlated with all carpet voxels.
+            Default: 5
+        save_all_pcs : boolean
+            Whether to compute all PCs (full SVD) instead of only
+            the first :ncomp:, and save them together with their
+            explained variance ratios in the output directory
+            ('PCs_all.npy' and 'PCs_all_expl_variance_ratio.npy').
+            This is considerably slower for large carpets.
             Default: False
         """
 
+        # Assert that ncomp can be taken as integer
+        try:
+            self.ncomp = int(ncomp)
+        except ValueError:
+            raise ValueError("'ncomp' must be an integer!")
+
         # Fit PCA
-        model = PCA(whiten=True)
-        pca_scores = model.fit_transform(self.carpet)
+        if save_all_pcs:
+            model = PCA(whiten=True)
+        else:
+            model = PCA(n_components=self.ncomp, svd_solver='randomized',
+                        whiten=True, random_state=0)
+        model.fit(self.carpet)
         self.pca_comps = model.components_
         self.expl_var = model.explained_variance_ratio_
 
         # Save results to npy files
-        np.save(os.path.join(self.output_dir, 'PCs_all.npy'),
-                self.pca_comps)
-        np.save(os.path.join(self.output_dir,
-                             'PCs_all_expl_variance_ratio.npy'),
-                self.expl_var)
+        if save_all_pcs:
+            np.save(os.path.join(self.output_dir, 'PCs_all.npy'),
+                    self.pca_comps)
+            np.save(os.path.join(self.output_dir,
+                                 'PCs_all_expl_variance_ratio.npy'),
+                    self.expl_var)
+        # PCA scores are only computed when they are to be saved
         if save_pca_scores:
-            np.save(os.path.join(self.output_dir, 'PCA_scores_all.npy'),
+            pca_scores = model.transform(self.carpet)
+            scores_name = 'all' if save_all_pcs else f'First{self.ncomp}'
+            np.save(os.path.join(self.output_dir,
+                                 f'PCA_scores_{scores_name}.npy'),
                     pca_scores)
         print("PCA fit to carpet and results saved.")
         return
 
-    def correlate_with_carpet(self, ncomp=5, flip_sign=True):
+    def correlate_with_carpet(self, ncomp=None, flip_sign=True):
         """ Correlates the first :ncomp: principal components (PCs)
         with all carpet voxel time-series. Saves the correlation matrix.
 
         Parameters
         ----------
-        ncomp : int
+        ncomp : int or None
             Number of PCA components to retain. These first PCs (fPCs)
-            are correlated with all carpet voxels.
-            Default: 5
+            are correlated with all carpet voxels. Cannot exceed
+            the number of PCs computed by :fit_pca2carpet:.
+            If None, all PCs computed by :fit_pca2carpet: are retained.
+            Default: None
         flip_sign : boolean
             If True, a PC (and its correlation with carpet voxels)
             will be sign-flipped when the median of its original
@@ -281,51 +422,69 @@ class Dataset(object):
             analysis and visualization (the saved PCA components, scores,
             and report have the original sign).
             Default: True
+
+        The (possibly sign-flipped) fPCs are stored as :self.fPCs:,
+        a 2d-array shaped ncomp x time (one row per fPC), with their
+        names ('PC1', 'PC2', ...) in :self.fPC_names:. Their correlations
+        with the carpet are stored as :self.fPC_carpet_R:,
+        a 2d-array shaped voxels x ncomp. The saved csv files keep
+        one column per fPC (time x ncomp).
         """
 
         # Assert that ncomp can be taken as integer
-        try:
-            self.ncomp = int(ncomp)
-        except ValueError:
-            print("'ncomp' must be an integer!")
-
-        # Pass first ncomp PCs (fPCs) to pandas dataframe and save as csv
-        comp_names = ['PC' + str(i + 1) for i in range(self.ncomp)]
-        fPCs = pd.DataFrame(data=self.pca_comps.T[:, :self.ncomp],
-                            columns=comp_names)
-        fPCs.to_csv(os.path.join(self.output_dir,
-                                 f'First{self.ncomp}_PCs.csv'), index=False)
+        if ncomp is not None:
+            try:
+                ncomp = int(ncomp)
+            except ValueError:
+                raise ValueError("'ncomp' must be an integer!")
+            if ncomp > self.pca_comps.shape[0]:
+                raise ValueError(f"Only {self.pca_comps.shape[0]} PCs "
+                                 "were computed by 'fit_pca2carpet'!")
+            self.ncomp = ncomp
+
+        # Keep first ncomp PCs (fPCs) as an array (ncomp x time)
+        # and save them as csv (one column per fPC)
+        comp_names = np.char.add(
+            'PC', np.arange(1, self.ncomp + 1).astype(str)).tolist()
+        fPCs = self.pca_comps[:self.ncomp].copy()
+        pd.DataFrame(data=fPCs.T, columns=comp_names).to_csv(
+            os.path.join(self.output_dir, f'First{self.ncomp}_PCs.csv'),
+            index=False)
 
         # Correlate fPCs with carpet matrix
-        fPC_carpet_R = pearsonr_2d(self.carpet, fPCs.values.T)
+        if self._carpet_is_zscored:
+            fPC_carpet_R = pearsonr_2d_prezscored(
+                self.carpet, zscore(fPCs, axis=1))
+        else:
+            fPC_carpet_R = pearsonr_2d(self.carpet, fPCs)
         np.save(os.path.join(self.output_dir,
                              f'First{self.ncomp}_PCs_carpet_corr.npy'),
                 fPC_carpet_R)
         # Save correlation matrix (voxels x ncom) as npy
-        print(f"First {ncomp} PCs correlated with carpet.")
+        print(f"First {self.ncomp} PCs correlated with carpet.")
 
         # Construct table reporting various metrics for each fPC
         report = pd.DataFrame()
         report.loc[:, 'PC'] = comp_names
-        report.loc[:, 'expl_var'] = self.expl_var[:ncomp]
-        report.loc[:, 'carpet_R_median'] = [np.median(fPC_carpet_R[:, i])
-                                            for i in range(self.ncomp)]
+        report.loc[:, 'expl_var'] = self.expl_var[:self.ncomp]
+        report.loc[:, 'carpet_R_median'] = np.median(fPC_carpet_R, axis=0)
         report.loc[:, 'sign_flipped'] = [False] * self.ncomp
 
         # Flip sign if asked
         N_flipped = 0
         if flip_sign:
-            for i, c in enumerate(fPCs):
-                if report.loc[i, 'carpet_R_median'] < 0:
-                    fPCs[c] = -1 * fPCs[c]
-                    fPC_carpet_R[:, i] = -1 * fPC_carpet_R[:, i]
-                    report.loc[i, 'sign_flipped'] = True
-                    N_flipped += 1
+            flipped = report['carpet_R_median'].values < 0
+            signs = np.where(flipped, -1, 1).astype(fPC_carpet_R.dtype)
+            fPCs *= signs[:, None]
+            fPC_carpet_R *= signs
+            report.loc[:, 'sign_flipped'] = flipped
+            N_flipped = int(np.count_nonzero(flipped))
         # If any flips occured, save flipped fPCs and their carpet correlation
         if N_flipped > 0:
-            fPCs.to_csv(os.path.join(self.output_dir,
-                                     f'First{self.ncomp}_PCs_flipped.csv'),
-                        index=False)
+            pd.DataFrame(data=fPCs.T, columns=comp_names).to_csv(
+                os.path.join(self.output_dir,
+                             f'First{self.ncomp}_PCs_flipped.csv'),
+                index=False)
             np.save(os.path.join(self.output_dir,
                     f'First{self.ncomp}_PCs_flipped_carpet_corr.npy'),
                     fPC_carpet_R)
@@ -337,6 +496,7 @@ class Dataset(object):
                       index=False)
 
         self.fPCs = fPCs
+        self.fPC_names = comp_names
         self.fPC_carpet_R = fPC_carpet_R
         return
 
@@ -350,13 +510,14 @@ class Dataset(object):
         # Reshape 4d fMRI data into a 2d (voxels * time) matrix
         fmri_2d = self.data.reshape((-1, self.t))
         # Correlate with PCs
-        fPC_fmri_R = pearsonr_2d(fmri_2d, self.fPCs.values.T)
+        fPC_fmri_R = pearsonr_2d(fmri_2d, self.fPCs)
         # Reshape correlation to 4d (3d space * components)
         fPC_fmri_R = fPC_fmri_R.reshape((self.x, self.y, self.z, self.ncomp))
         # Create appropriate NIFTI header
         header = self.header.copy()
         header['dim'][4] = self.ncomp
         header['pixdim'][4] = 1
+        header.set_data_dtype(np.float32)
         # Save correlation maps as NIFTI
         output_nifti = nib.Nifti1Image(fPC_fmri_R, self.affine,
                                        header=header)
@@ -413,18 +574,17 @@ class Dataset(object):
                      orientation='horizontal')
 
         # Plot fPCs
-        ymin = np.min(self.fPCs.values)
-        ymax = np.max(self.fPCs.values)
+        ymin = np.min(self.fPCs)
+        ymax = np.max(self.fPCs)
         for i in range(npc):
             axpc = plt.subplot2grid((6 + npc, 5), (6 + i, 0), colspan=3)
-            pc = self.fPCs[self.fPCs.columns[i]]
-            axpc.plot(pc, color='0.2', lw=1.5)
+            axpc.plot(self.fPCs[i], color='0.2', lw=1.5)
             axpc.set_ylim(ymin, ymax)
             axpc.set_xlim(0, self.t)
             axpc.axis('off')
             axpc_coords = get_axis_coords(fig, axpc)
             fig.text(axpc_coords['xmin'] - 0.015, axpc_coords['ycen'],
-                     self.fPCs.columns[i], ha='right', va='center')
+                     self.fPC_names[i], ha='right', va='center')
             if i == 0:
                 axpc.set_title('Principal Components (PCs)')
         # Plot time scalebar
@@ -543,10 +703,14 @@ class Dataset(object):
             in the output directory. The file might be large
             (possibly > 100MB depending on fMRI data and mask size).
             Default: False
+        save_all_pcs : boolean
+            Whether to compute all PCs (full SVD) instead of only the
+            first :ncomp:, and save them in the output directory.
+            Default: False
         ncomp : int
-            Number of PCA components to retain. These first PCs (fPCs)
-            are correlated with all carpet voxels and subsequently
-            also with the entire fMRI dataset.
+            Number of PCA components to compute and retain. These first
+            PCs (fPCs) are correlated with all carpet voxels and
+            subsequently also with the entire fMRI dataset.
             Default: 5
         flip_sign : boolean
             If True, an fPC (and its correlation values) will be sign-flipped
@@ -566,7 +730,8 @@ class Dataset(object):
         # Define default options in a dictionary
         options = {'tSNR_thresh': 15.0, 'reorder_carpet': True,
                    'save_carpet': False, 'save_pca_scores': False,
-                   'ncomp': 5, 'flip_sign': True, 'TR': 'auto'}
+                   'save_all_pcs': False, 'ncomp': 5, 'flip_sign': True,
+                   'TR': 'auto'}
 
         # Override default if any of the options is given
         # explicitly as a keyword argument
@@ -581,8 +746,9 @@ class Dataset(object):
         self.get_carpet(tSNR_thresh=options['tSNR_thresh'],
                         reorder_carpet=options['reorder_carpet'],
                         save_carpet=options['save_carpet'])
-        self.fit_pca2carpet(save_pca_scores=options['save_pca_scores'])
-        self.correlate_with_carpet(ncomp=options['ncomp'],
-                                   flip_sign=options['flip_sign'])
+        self.fit_pca2carpet(ncomp=options['ncomp'],
+                            save_pca_scores=options['save_pca_scores'],
+                            save_all_pcs=options['save_all_pcs'])
+        self.correlate_with_carpet(flip_sign=options['flip_sign'])
         self.correlate_with_fmri()
         self.plot_report(TR=options['TR'])
@@ -3,6 +3,8 @@ import os.path as op
 import numpy as np
 import pandas as pd
 import numpy.testing as npt
+import pytest
+from scipy.stats import zscore
 import pcarpet as sb
 
 data_path = op.join(sb.__path__[0], 'data')
@@ -107,3 +109,212 @@ def test_params_regression():
     npt.assert_almost_equal(ortho_fit.params[1], 0.13845926)
     npt.assert_almost_equal(para_fit.params[0], 0.57456788)
     npt.assert_almost_equal(para_fit.params[1], 0.13684096)
+
+
+def _random_rows(n_rows, dtype=np.float64):
+    """Random arrays A (n_rows x 50) and B (3 x 50) for correlation tests"""
+    rng = np.random.RandomState(42)
+    A = rng.randn(n_rows, 50).astype(dtype)
+    B = rng.randn(3, 50)
+    return A, B
+
+
+def test_pearsonr_2d():
+    A, B = _random_rows(20)
+    R = sb.pearsonr_2d(A, B)
+    npt.assert_equal(R.shape, (20, 3))
+    # Compare against numpy's correlation matrix
+    expected = np.corrcoef(A, B)[:20, 20:]
+    npt.assert_almost_equal(R, expected)
+    # Perfectly correlated and anti-correlated rows
+    R = sb.pearsonr_2d(B, np.vstack([2 * B[0] + 1, -B[0]]))
+    npt.assert_almost_equal(R[0], [1, -1])
+    # Integer input is not truncated
+    A_int = (100 * A).astype(np.int16)
+    R = sb.pearsonr_2d(A_int, B)
+    npt.assert_almost_equal(R, np.corrcoef(A_int, B)[:20, 20:], decimal=5)
+
+
+def test_pearsonr_2d_prezscored():
+    A, B = _random_rows(20)
+    R = sb.pearsonr_2d_prezscored(zscore(A, axis=1), zscore(B, axis=1))
+    npt.assert_almost_equal(R, sb.pearsonr_2d(A, B))
+    R = sb.pearsonr_2d_prezscored(zscore(A, axis=1, ddof=1),
+                                  zscore(B, axis=1, ddof=1), ddof=1)
+    npt.assert_almost_equal(R, sb.pearsonr_2d(A, B))
+    # A single signal gives a 1d-array of correlations
+    R = sb.pearsonr_2d_prezscored(zscore(A, axis=1), zscore(B[0]))
+    npt.assert_almost_equal(R, sb.pearsonr_2d(A, B[:1]).ravel())
+
+
+def test_pearsonr_2d_chunked(monkeypatch):
+    # float32 input, with a row count that is not a multiple
+    # of the number of rows per block
+    A, B = _random_rows(2001, dtype=np.float32)
+    expected = np.corrcoef(A, B)[:2001, 2001:]
+    # Force the row-block code path
+    monkeypatch.setattr(sb.pcarpet, 'CHUNK_THRESH_BYTES', 0)
+    R = sb.pearsonr_2d(A, B)
+    npt.assert_equal(R.dtype, np.float32)
+    npt.assert_almost_equal(R, expected, decimal=5)
+    # Integer input is also processed in blocks
+    A_int = (100 * A).astype(np.int16)
+    R = sb.pearsonr_2d(A_int, B)
+    npt.assert_almost_equal(R, np.corrcoef(A_int, B)[:2001, 2001:],
+                            decimal=5)
+
+
+def test_get_carpet(tmp_path):
+    rng = np.random.RandomState(42)
+    t = 40
+    noise = rng.randn(2, 3, 1, t)
+    means = np.array([100, 100, 10, 100, 50, 200]).reshape((2, 3, 1, 1))
+    stds = np.array([1, 2, 5, 1, 0, 3]).reshape((2, 3, 1, 1))
+    data = (means + stds * noise).astype(np.float32)
+    # The 4th voxel lies outside the mask
+    mask = np.array([1, 1, 1, 0, 1, 1], dtype=np.float32).reshape((2, 3, 1))
+
+    ds = sb.Dataset('fmri.nii.gz', 'mask.nii.gz', str(tmp_path))
+    ds.data, ds.mask = data, mask
+    ds.x, ds.y, ds.z, ds.t = data.shape
+    ds.get_carpet(tSNR_thresh=15.0, reorder_carpet=False)
+
+    # The 3rd voxel (tSNR = 2) is excluded, the constant voxel is kept
+    data_64 = data.astype(np.float64)
+    with np.errstate(divide='ignore'):
+        tsnr_ok = data_64.mean(-1) / data_64.std(-1) >= 15.0
+    keep = (mask >= 0.5) & tsnr_ok
+    npt.assert_equal(ds.carpet.shape, (4, t))
+    expected = data[keep]
+    constant = np.all(expected == expected[:, :1], axis=1)
+    npt.assert_equal(constant, [False, False, True, False])
+    npt.assert_almost_equal(ds.carpet[~constant],
+                            zscore(expected[~constant], axis=1), decimal=5)
+    # A constant voxel gives a row of zeros (rather than NaNs)
+    npt.assert_equal(ds.carpet[constant], 0)
+
+    # Without a tSNR threshold, all voxels within the mask are kept
+    ds.get_carpet(tSNR_thresh=None, reorder_carpet=False)
+    npt.assert_equal(ds.carpet.shape, (5, t))
+
+
+def test_correlate_with_carpet(tmp_path):
+    rng = np.random.RandomState(42)
+    t, ncomp = 30, 3
+    pcs = rng.randn(ncomp, t)
+    # Most voxels correlate positively with PC1 and PC3,
+    # but negatively with PC2
+    weights = np.abs(rng.randn(200, ncomp)) * [1, -1, 1]
+    carpet = weights @ pcs + 0.5 * rng.randn(200, t)
+
+    ds = sb.Dataset('fmri.nii.gz', 'mask.nii.gz', str(tmp_path))
+    ds.carpet = carpet
+    ds.pca_comps = pcs
+    ds.expl_var = np.array([0.5, 0.3, 0.2])
+    ds.ncomp = ncomp
+    ds.correlate_with_carpet(flip_sign=True)
+
+    # Only PC2 is flipped, together with its carpet correlations
+    R = sb.pearsonr_2d(carpet, pcs)
+    signs = np.array([1, -1, 1])
+    npt.assert_equal(ds.fPCs.shape, (ncomp, t))
+    npt.assert_almost_equal(ds.fPCs, pcs * signs[:, None])
+    npt.assert_almost_equal(ds.fPC_carpet_R, R * signs)
+    report = pd.read_csv(op.join(tmp_path,
+                                 'First3_PCs_carpet_corr_report.csv'))
+    npt.assert_equal(report['sign_flipped'].values, [False, True, False])
+
+    # Saved PCs keep one column per PC (time x ncomp),
+    # with the original sign unless flipped
+    saved = pd.read_csv(op.join(tmp_path, 'First3_PCs.csv'))
+    npt.assert_equal(list(saved.columns), ['PC1', 'PC2', 'PC3'])
+    npt.assert_almost_equal(saved.values, pcs.T)
+    saved = pd.read_csv(op.join(tmp_path, 'First3_PCs_flipped.csv'))
+    npt.assert_equal(list(saved.columns), ['PC1', 'PC2', 'PC3'])
+    npt.assert_almost_equal(saved.values, (pcs * signs[:, None]).T)
+
+    # Fewer PCs than fitted can be retained, but not more
+    ds.correlate_with_carpet(ncomp=2, flip_sign=False)
+    npt.assert_almost_equal(ds.fPCs, pcs[:2])
+    with pytest.raises(ValueError):
+        ds.correlate_with_carpet(ncomp=ncomp + 1)
+
+
+def _random_dataset(tmp_path, t=40):
+    """Dataset with a random 4x5x3 volume (all voxels in the mask),
+    set directly instead of being imported from NIFTI files"""
+    rng = np.random.RandomState(42)
+    data = (100 + 5 * rng.randn(4, 5, 3, t)).astype(np.float32)
+    ds = sb.Dataset('fmri.nii.gz', 'mask.nii.gz', str(tmp_path))
+    ds.data, ds.mask = data, np.ones(data.shape[:3], dtype=np.float32)
+    ds.x, ds.y, ds.z, ds.t = data.shape
+    return ds
+
+
+def test_carpet_reassigned(tmp_path):
+    ds = _random_dataset(tmp_path)
+    ds.get_carpet(tSNR_thresh=None)
+    # Replace the z-scored carpet by raw (not z-scored) voxel signals
+    raw = ds.data.reshape((-1, ds.t))
+    ds.carpet = raw
+    ds.pca_comps = np.random.RandomState(0).randn(3, ds.t)
+    ds.expl_var = np.array([0.5, 0.3, 0.2])
+    ds.ncomp = 3
+    ds.correlate_with_carpet(flip_sign=False)
+    npt.assert_almost_equal(ds.fPC_carpet_R,
+                            sb.pearsonr_2d(raw, ds.pca_comps), decimal=5)
+
+
+def test_fit_pca2carpet(tmp_path):
+    ds = _random_dataset(tmp_path)
+    ds.get_carpet(tSNR_thresh=None)
+
+    # By default, only the first ncomp PCs are computed and saved
+    ds.fit_pca2carpet(True, ncomp=3)
+    npt.assert_equal(ds.pca_comps.shape, (3, ds.t))
+    npt.assert_equal(ds.expl_var.shape, (3,))
+    assert not op.exists(op.join(tmp_path, 'PCs_all.npy'))
+    assert not op.exists(op.join(tmp_path,
+                                 'PCs_all_expl_variance_ratio.npy'))
+    scores = np.load(op.join(tmp_path, 'PCA_scores_First3.npy'))
+    npt.assert_equal(scores.shape, (ds.carpet.shape[0], 3))
+    # All fitted PCs are retained by default
+    ds.correlate_with_carpet()
+    npt.assert_equal(ds.ncomp, 3)
+    npt.assert_equal(ds.fPC_carpet_R.shape, (ds.carpet.shape[0], 3))
+
+    # Full decomposition, with all PCs saved
+    ds.fit_pca2carpet(save_pca_scores=True, ncomp=3, save_all_pcs=True)
+    npt.assert_equal(ds.pca_comps.shape, (ds.t, ds.t))
+    pcs_all = np.load(op.join(tmp_path, 'PCs_all.npy'))
+    npt.assert_equal(pcs_all.shape, (ds.t, ds.t))
+    assert op.exists(op.join(tmp_path, 'PCs_all_expl_variance_ratio.npy'))
+    scores = np.load(op.join(tmp_path, 'PCA_scores_all.npy'))
+    npt.assert_equal(scores.shape, (ds.carpet.shape[0], ds.t))
+
+
+def test_load_carpet(tmp_path):
+    ds = _random_dataset(tmp_path)
+    ds.get_carpet(tSNR_thresh=None, save_carpet=True)
+    carpet = ds.carpet
+
+    # Memory-mapped (read-only) round trip
+    ds = sb.Dataset('fmri.nii.gz', 'mask.nii.gz', str(tmp_path))
+    loaded = ds.load_carpet()
+    assert isinstance(loaded, np.memmap)
+    assert not loaded.flags.writeable
+    npt.assert_equal(loaded.dtype, np.float32)
+    npt.assert_equal(loaded, carpet)
+    assert ds.carpet is loaded
+    # PCA and correlations run on the memory-mapped carpet
+    ds.fit_pca2carpet(ncomp=3)
+    ds.correlate_with_carpet()
+    npt.assert_almost_equal(ds.fPC_carpet_R,
+                            sb.pearsonr_2d(np.array(loaded), ds.fPCs),
+                            decimal=5)
+
+    # Loaded entirely into memory
+    loaded = ds.load_carpet(mmap=False)
+    assert not isinstance(loaded, np.memmap)
+    assert loaded.flags.writeable
+    npt.assert_equal(loaded, carpet)